@@ -3,17 +3,50 @@ import json
 import io
 import re
 import traceback
+import os
+import math
+import hashlib
+import threading
+import time
 from docx import Document
 from docx.shared import Pt, RGBColor, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.enum.style import WD_STYLE_TYPE
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
 from lxml import etree
 import copy
+from functools import lru_cache
 
 MATH_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/math'
 W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
 
+# id стилей, которые ChatRenderer добавляет в документ (см. add_chat_styles)
+USER_LABEL_STYLE = 'ChatUserLabel'
+MODEL_LABEL_STYLE = 'ChatModelLabel'
+SEPARATOR_STYLE = 'ChatSeparator'
+CODE_STYLE = 'ChatCode'
+TABLE_CELL_STYLE = 'ChatTableCell'
+MATH_STYLE = 'ChatMath'
+CODE_KEYWORD_STYLE = 'ChatCodeKeyword'
+CODE_STRING_STYLE = 'ChatCodeString'
+CODE_COMMENT_STYLE = 'ChatCodeComment'
+CODE_NUMBER_STYLE = 'ChatCodeNumber'
+
+# Отображаемые имена стилей в Word; styleId задаётся явно из констант выше
+STYLE_NAMES = {
+    USER_LABEL_STYLE: 'Chat User Label',
+    MODEL_LABEL_STYLE: 'Chat Model Label',
+    SEPARATOR_STYLE: 'Chat Separator',
+    CODE_STYLE: 'Chat Code',
+    TABLE_CELL_STYLE: 'Chat Table Cell',
+    MATH_STYLE: 'Chat Math',
+    CODE_KEYWORD_STYLE: 'Chat Code Keyword',
+    CODE_STRING_STYLE: 'Chat Code String',
+    CODE_COMMENT_STYLE: 'Chat Code Comment',
+    CODE_NUMBER_STYLE: 'Chat Code Number',
+}
+
 def make_el(ns, tag):
     return etree.Element(f'{{{ns}}}{tag}')
 
@@ -29,11 +62,10 @@ def make_run(text, italic=True, bold=False):
     else:
         sty = sub_el(rpr, MATH_NS, 'sty')
         sty.set(f'{{{MATH_NS}}}val', 'bi' if bold else 'i')
-    # Word run properties for font
+    # Шрифт Cambria Math задаётся стилем
     wrpr = sub_el(r, W_NS, 'rPr')
-    rfonts = sub_el(wrpr, W_NS, 'rFonts')
-    rfonts.set(f'{{{W_NS}}}ascii', 'Cambria Math')
-    rfonts.set(f'{{{W_NS}}}hAnsi', 'Cambria Math')
+    rstyle = sub_el(wrpr, W_NS, 'rStyle')
+    rstyle.set(f'{{{W_NS}}}val', MATH_STYLE)
     t = sub_el(r, MATH_NS, 't')
     t.text = text
     t.set(f'{{{W_NS}}}space', 'preserve')
@@ -204,15 +236,34 @@ FUNCTIONS = {
 }
 
 
-def parse_latex(latex):
+class FormulaTooComplex(ValueError):
+    """Формула превышает лимиты длины, вложенности или времени разбора"""
+
+
+# Лимиты на одну формулу; при превышении insert_math вставляет её как текст
+FORMULA_MAX_LENGTH = int(os.environ.get('FORMULA_MAX_LENGTH', 2000))
+FORMULA_MAX_DEPTH = int(os.environ.get('FORMULA_MAX_DEPTH', 40))
+FORMULA_TIME_BUDGET = float(os.environ.get('FORMULA_TIME_BUDGET', 0.25))
+
+
+def parse_latex(latex, level=0, deadline=None):
+    if level > FORMULA_MAX_DEPTH:
+        raise FormulaTooComplex(f'nesting deeper than {FORMULA_MAX_DEPTH}')
+    
+    def sub(text):
+        return parse_latex(text, level + 1, deadline)
+    
     elements = []
     i = 0
     s = latex.strip()
     
     while i < len(s):
+        if deadline is not None and time.monotonic() > deadline:
+            raise FormulaTooComplex(f'parse took longer than {FORMULA_TIME_BUDGET}s')
         c = s[i]
         
-        if c == ' ':
+        if c in ' \t}$':
+            # Пробелы, а также лишние } и $ без пары — пропускаем
             i += 1
             continue
         
@@ -224,7 +275,7 @@ def parse_latex(latex):
                 elif s[j] == '}': depth -= 1
                 j += 1
             inner = s[i+1:j-1]
-            elements.extend(parse_latex(inner))
+            elements.extend(sub(inner))
             i = j
             continue
         
@@ -250,8 +301,8 @@ def parse_latex(latex):
             if cmd == r'\frac':
                 num_c, after_n = _read_group(s, j)
                 den_c, after_d = _read_group(s, after_n)
-                num_els = parse_latex(num_c) or [make_run(' ')]
-                den_els = parse_latex(den_c) or [make_run(' ')]
+                num_els = sub(num_c) or [make_run(' ')]
+                den_els = sub(den_c) or [make_run(' ')]
                 elements.append(make_frac(num_els, den_els))
                 i = after_d
                 continue
@@ -273,7 +324,7 @@ def parse_latex(latex):
             }
             if cmd in accents_map:
                 content, after = _read_group(s, j)
-                inner_els = parse_latex(content) or [make_run(' ')]
+                inner_els = sub(content) or [make_run(' ')]
                 elements.append(make_accent(inner_els, accents_map[cmd]))
                 i = after
                 continue
@@ -289,10 +340,10 @@ def parse_latex(latex):
                     end_bracket = s.find(']', pos)
                     if end_bracket > 0:
                         deg_content = s[pos+1:end_bracket]
-                        deg_els = parse_latex(deg_content)
+                        deg_els = sub(deg_content)
                         pos = end_bracket + 1
                 content, after = _read_group(s, pos)
-                inner_els = parse_latex(content) or [make_run(' ')]
+                inner_els = sub(content) or [make_run(' ')]
                 elements.append(make_sqrt(inner_els, deg_els))
                 i = after
                 continue
@@ -307,7 +358,7 @@ def parse_latex(latex):
                     end_pos = right_pos + 6  # len(\right)
                     end_char = s[end_pos] if end_pos < len(s) else ')'
                     if end_char == '.': end_char = ''
-                    inner_els = parse_latex(inner) or [make_run(' ')]
+                    inner_els = sub(inner) or [make_run(' ')]
                     elements.append(make_delim(inner_els, beg_char or '(', end_char or ')'))
                     i = end_pos + 1
                 else:
@@ -367,13 +418,13 @@ def parse_latex(latex):
         # ^ верхний индекс
         if c == '^':
             sup_c, after = _read_group_or_char(s, i+1)
-            sup_els = parse_latex(sup_c) or [make_run(' ')]
+            sup_els = sub(sup_c) or [make_run(' ')]
             if elements:
-                base = elements.pop()
+                base = _pop_script_base(elements, level)
                 # Проверяем: если дальше идёт _, то это subsup
                 if after < len(s) and s[after] == '_':
                     sub_c, after2 = _read_group_or_char(s, after+1)
-                    sub_els2 = parse_latex(sub_c) or [make_run(' ')]
+                    sub_els2 = sub(sub_c) or [make_run(' ')]
                     elements.append(make_subsup([base], sub_els2, sup_els))
                     i = after2
                 else:
@@ -387,13 +438,13 @@ def parse_latex(latex):
         # _ нижний индекс
         if c == '_':
             sub_c, after = _read_group_or_char(s, i+1)
-            sub_els = parse_latex(sub_c) or [make_run(' ')]
+            sub_els = sub(sub_c) or [make_run(' ')]
             if elements:
-                base = elements.pop()
+                base = _pop_script_base(elements, level)
                 # Проверяем: если дальше идёт ^, то это subsup
                 if after < len(s) and s[after] == '^':
                     sup_c2, after2 = _read_group_or_char(s, after+1)
-                    sup_els2 = parse_latex(sup_c2) or [make_run(' ')]
+                    sup_els2 = sub(sup_c2) or [make_run(' ')]
                     elements.append(make_subsup([base], sub_els, sup_els2))
                     i = after2
                 else:
@@ -404,26 +455,39 @@ def parse_latex(latex):
                 i = after
             continue
         
-        # Обычные символы
+        # Обычные символы; подряд идущие операторы и знаки — в одном прямом run
         text = ''
-        while i < len(s) and s[i] not in '\\{}^_$ \t':
+        ops = ''
+        while i < len(s) and s[i] not in '\\{}^_$\t':
             ch = s[i]
-            if ch in '+-=<>':
+            if ch == ' ':
+                # Пробел завершает текстовый run, но не цепочку операторов
                 if text:
                     elements.append(make_run(text))
                     text = ''
-                elements.append(make_run(ch, italic=False))
                 i += 1
                 continue
-            if ch in '(),.:;!?[]|/':
+            if ch in '+-=<>(),.:;!?[]|/':
                 if text:
                     elements.append(make_run(text))
                     text = ''
-                elements.append(make_run(ch, italic=False))
+                if _before_script(s, i + 1):
+                    # Основанием ^/_ остаётся только этот символ
+                    if ops:
+                        _append_upright(elements, ops)
+                        ops = ''
+                    elements.append(make_run(ch, italic=False))
+                else:
+                    ops += ch
                 i += 1
                 continue
+            if ops:
+                _append_upright(elements, ops)
+                ops = ''
             text += ch
             i += 1
+        if ops:
+            _append_upright(elements, ops)
         if text:
             elements.append(make_run(text))
         continue
@@ -431,21 +495,56 @@ def parse_latex(latex):
     return elements
 
 
+M_STY_VAL = f'{{{MATH_NS}}}val'
+
+
+def _append_upright(elements, text):
+    """Добавляет прямой текст, дописывая его в предыдущий прямой m:r, если он есть"""
+    prev = elements[-1] if elements else None
+    if (prev is not None and prev.tag == f'{{{MATH_NS}}}r'
+            and prev[0][0].get(M_STY_VAL) == 'p' and len(prev) == 3):
+        prev[2].text += text
+    else:
+        elements.append(make_run(text, italic=False))
+
+
+_SCRIPT_TAGS = {f'{{{MATH_NS}}}{t}' for t in ('sSup', 'sSub', 'sSubSup')}
+
+
+def _pop_script_base(elements, level):
+    """Снимает основание для ^/_; цепочка x^x^x^… тоже считается вложенностью"""
+    base = elements.pop()
+    depth = level + 1
+    el = base
+    while el is not None and el.tag in _SCRIPT_TAGS:
+        depth += 1
+        if depth > FORMULA_MAX_DEPTH:
+            raise FormulaTooComplex(f'nesting deeper than {FORMULA_MAX_DEPTH}')
+        e = el.find(f'{{{MATH_NS}}}e')
+        el = e[0] if e is not None and len(e) else None
+    return base
+
+
+def _before_script(s, pos):
+    """True, если с позиции pos (после пробелов) начинается ^ или _"""
+    while pos < len(s) and s[pos] == ' ':
+        pos += 1
+    return pos < len(s) and s[pos] in '^_'
+
+
+_LEFT_RIGHT = re.compile(r'\\left|\\right')
+
+
 def _find_matching_right(s, start):
     """Ищет \right соответствующую \left"""
     depth = 1
-    i = start
-    while i < len(s) - 5:
-        if s[i:i+5] == r'\left':
+    for m in _LEFT_RIGHT.finditer(s, start):
+        if m.group() == r'\left':
             depth += 1
-            i += 5
-        elif s[i:i+6] == r'\right':
+        else:
             depth -= 1
             if depth == 0:
-                return i
-            i += 6
-        else:
-            i += 1
+                return m.start()
     return -1
 
 
@@ -483,8 +582,10 @@ def _read_group_or_char(s, pos):
 
 
 def build_omath(latex):
+    if len(latex) > FORMULA_MAX_LENGTH:
+        raise FormulaTooComplex(f'longer than {FORMULA_MAX_LENGTH} chars')
     omath = make_el(MATH_NS, 'oMath')
-    elements = parse_latex(latex)
+    elements = parse_latex(latex, deadline=time.monotonic() + FORMULA_TIME_BUDGET)
     for el in elements:
         omath.append(el)
     return omath
@@ -496,14 +597,20 @@ def insert_math(paragraph, latex):
         paragraph._element.append(omath)
         return True
     except Exception as e:
-        print(f'Math error "{latex}": {e}')
-        traceback.print_exc()
+        if isinstance(e, FormulaTooComplex):
+            print(f'Math skipped "{latex[:80]}": {e}')
+        else:
+            print(f'Math error "{latex}": {e}')
+            traceback.print_exc()
         r = paragraph.add_run(latex)
-        r.font.name = 'Cambria Math'
+        r._r.style = MATH_STYLE
         r.italic = True
         return False
 
 
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+
 def add_block_formula(doc, latex):
     p = doc.add_paragraph()
     p.alignment = WD_ALIGN_PARAGRAPH.CENTER
@@ -511,121 +618,231 @@ def add_block_formula(doc, latex):
 
 
 # =============================================
-# HTTP Handler
+# Подсветка кода
+# =============================================
+
+# Общие для C-подобных языков правила комментариев и строк
+_C_COMMENT = r'//.*|/\*.*?(?:\*/|$)'
+_C_STRINGS = r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\''
+
+CODE_LANGUAGES = {
+    'python': dict(
+        keywords='False None True and as assert async await break class continue '
+                 'def del elif else except finally for from global if import in is '
+                 'lambda nonlocal not or pass raise return try while with yield',
+        comment=r'#.*', strings=r'[rbfu]{0,2}(?:"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')'),
+    'js': dict(
+        keywords='async await break case catch class const continue debugger default '
+                 'delete do else export extends false finally for from function if '
+                 'import in instanceof interface let new null of return super switch '
+                 'this throw true try type typeof undefined var void while yield',
+        comment=r'//.*|/\*.*?(?:\*/|$)',
+        strings=r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`(?:\\.|[^`\\])*`'),
+    'c': dict(
+        keywords='alignas alignof auto bool break case catch char class const constexpr '
+                 'continue default delete do double else enum explicit extern false '
+                 'float for friend goto if inline int long mutable namespace new '
+                 'noexcept nullptr operator private protected public register return '
+                 'short signed sizeof static struct switch template this throw true '
+                 'try typedef typename union unsigned using virtual void volatile while',
+        comment=_C_COMMENT, strings=_C_STRINGS),
+    'java': dict(
+        keywords='abstract assert boolean break byte case catch char class const '
+                 'continue default do double else enum extends false final finally '
+                 'float for goto if implements import instanceof int interface long '
+                 'native new null package private protected public record return '
+                 'short static strictfp super switch synchronized this throw throws '
+                 'transient true try var void volatile while',
+        comment=_C_COMMENT, strings=_C_STRINGS),
+    'csharp': dict(
+        keywords='abstract as async await base bool break byte case catch char checked '
+                 'class const continue decimal default delegate do double else enum '
+                 'event explicit extern false finally fixed float for foreach goto if '
+                 'implicit in int interface internal is lock long namespace new null '
+                 'object operator out override params private protected public '
+                 'readonly ref return sbyte sealed short sizeof stackalloc static '
+                 'string struct switch this throw true try typeof uint ulong unchecked '
+                 'unsafe ushort using var virtual void volatile while',
+        comment=_C_COMMENT, strings=_C_STRINGS),
+    'go': dict(
+        keywords='break case chan const continue default defer else fallthrough false '
+                 'for func go goto if import interface map nil package range return '
+                 'select struct switch true type var',
+        comment=_C_COMMENT,
+        strings=r'"(?:\\.|[^"\\])*"|`[^`]*`|\'(?:\\.|[^\'\\])*\''),
+    'rust': dict(
+        keywords='as async await break const continue crate dyn else enum extern false '
+                 'fn for if impl in let loop match mod move mut pub ref return self '
+                 'Self static struct super trait true type unsafe use where while',
+        comment=_C_COMMENT,
+        # Только символьные литералы из одного символа — 'a в <'a> это время жизни
+        strings=r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])\''),
+    'shell': dict(
+        keywords='case do done elif else esac export fi for function if in local '
+                 'read return set then unset until while',
+        comment=r'#.*', strings=r'"(?:\\.|[^"\\])*"|\'[^\']*\''),
+    'sql': dict(
+        keywords='select from where and or not insert into values update set delete '
+                 'create table drop alter index join left right inner outer on group '
+                 'by order having limit as distinct null is in like union all',
+        comment=r'--.*', strings=r"'(?:''|[^'])*'", ignore_case=True),
+    'json': dict(
+        keywords='true false null', comment=None, strings=r'"(?:\\.|[^"\\])*"'),
+}
+
+CODE_ALIASES = {
+    'py': 'python', 'python3': 'python',
+    'javascript': 'js', 'jsx': 'js', 'ts': 'js', 'typescript': 'js', 'tsx': 'js',
+    'cpp': 'c', 'c++': 'c', 'h': 'c', 'hpp': 'c',
+    'cs': 'csharp', 'c#': 'csharp', 'golang': 'go', 'rs': 'rust',
+    'sh': 'shell', 'bash': 'shell', 'zsh': 'shell', 'console': 'shell',
+}
+
+_TOKEN_STYLES = {
+    'comment': CODE_COMMENT_STYLE, 'string': CODE_STRING_STYLE,
+    'keyword': CODE_KEYWORD_STYLE, 'number': CODE_NUMBER_STYLE,
+}
+
+
+def _code_language(lang):
+    """Каноническое имя языка из ```тега или None, если подсветки для него нет"""
+    name = CODE_ALIASES.get(lang, lang)
+    return name if name in CODE_LANGUAGES else None
+
+
+def _code_lexer(lang):
+    """Скомпилированный regex-лексер для языка или None (без подсветки)"""
+    name = _code_language(lang)
+    return _compile_lexer(name) if name else None
+
+
+@lru_cache(maxsize=None)  # ключ — только имена из CODE_LANGUAGES, тег из запроса сюда не попадает
+def _compile_lexer(name):
+    spec = CODE_LANGUAGES[name]
+    parts = []
+    if spec['comment']:
+        parts.append(f"(?P<comment>{spec['comment']})")
+    parts.append(f"(?P<string>{spec['strings']})")
+    words = '|'.join(sorted(spec['keywords'].split(), key=len, reverse=True))
+    parts.append(rf'(?P<keyword>\b(?:{words})\b)')
+    parts.append(r'(?P<number>\b(?:0[xX][0-9a-fA-F]+|\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)\b)')
+    return re.compile('|'.join(parts), re.IGNORECASE if spec.get('ignore_case') else 0)
+
+
+def _make_code_run(text, style=None, line_break=False):
+    r = make_el(W_NS, 'r')
+    if style:
+        rpr = sub_el(r, W_NS, 'rPr')
+        sub_el(rpr, W_NS, 'rStyle').set(f'{{{W_NS}}}val', style)
+    if line_break:
+        sub_el(r, W_NS, 'br')
+    if text:
+        t = sub_el(r, W_NS, 't')
+        t.text = text
+        t.set(XML_SPACE, 'preserve')
+    return r
+
+
+@lru_cache(maxsize=8192)
+def _code_line_runs(lang, line, line_break):
+    """Шаблоны w:r для одной строки кода; при вставке копируются.
+
+    _code передаёт каноническое имя языка, чтобы py и python делили кэш.
+    """
+    line = line.expandtabs(4)
+    lexer = _code_lexer(lang)
+    if lexer is None or not line.strip():
+        return (_make_code_run(line, line_break=line_break),)
+    runs = []
+    pos = 0
+    for m in lexer.finditer(line):
+        if m.start() > pos:
+            runs.append(_make_code_run(line[pos:m.start()], line_break=line_break and not runs))
+        runs.append(_make_code_run(m.group(), _TOKEN_STYLES[m.lastgroup],
+                                   line_break=line_break and not runs))
+        pos = m.end()
+    if pos < len(line):
+        runs.append(_make_code_run(line[pos:], line_break=line_break and not runs))
+    return tuple(runs)
+
+
+# =============================================
+# Renderer
 # =============================================
 
-class handler(BaseHTTPRequestHandler):
+def add_chat_styles(doc):
+    """Добавляет в документ именованные стили вместо прямого форматирования run-ов"""
+    styles = doc.styles
     
-    def _cors(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS, GET')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.send_header('Access-Control-Max-Age', '3600')
+    def add_style(style_id, style_type):
+        st = styles.add_style(STYLE_NAMES[style_id], style_type)
+        st.style_id = style_id
+        return st
     
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self._cors()
-        self.end_headers()
+    def char_style(style_id, size=None, bold=None, color=None, font=None):
+        st = add_style(style_id, WD_STYLE_TYPE.CHARACTER)
+        if size: st.font.size = Pt(size)
+        if bold: st.font.bold = True
+        if color: st.font.color.rgb = color
+        if font: st.font.name = font
+        return st
+    
+    char_style(USER_LABEL_STYLE, size=14, bold=True, color=RGBColor(33, 150, 243))
+    char_style(MODEL_LABEL_STYLE, size=14, bold=True, color=RGBColor(76, 175, 80))
+    char_style(SEPARATOR_STYLE, color=RGBColor(200, 200, 200))
+    char_style(TABLE_CELL_STYLE, size=11)
+    char_style(MATH_STYLE, font='Cambria Math')
+    char_style(CODE_KEYWORD_STYLE, bold=True, color=RGBColor(0, 0, 255))
+    char_style(CODE_STRING_STYLE, color=RGBColor(163, 21, 21))
+    char_style(CODE_COMMENT_STYLE, color=RGBColor(0, 128, 0)).font.italic = True
+    char_style(CODE_NUMBER_STYLE, color=RGBColor(9, 134, 88))
+    
+    code = add_style(CODE_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+    code.base_style = styles['Normal']
+    code.font.name = 'Courier New'
+    code.font.size = Pt(10)
+    shd = OxmlElement('w:shd')
+    shd.set(qn('w:val'), 'clear')
+    shd.set(qn('w:fill'), 'F5F5F5')
+    code.element.get_or_add_pPr().append(shd)
 
-    def do_GET(self):
-        self.send_response(200)
-        self._cors()
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
+
+class ChatRenderer:
+    """Собирает .docx из списка сообщений (общий код для HTTP и CLI)"""
+
+    def render(self, messages, title='Gemini Chat'):
+        doc = Document()
+        add_chat_styles(doc)
         
-        test = 'not tested'
-        tests = {}
-        try:
-            # Тест 1: простая дробь
-            omath = build_omath(r'\frac{a}{b}')
-            tests['frac'] = f'OK ({len(list(omath))} children)'
+        h = doc.add_heading(title, level=1)
+        h.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        dp = doc.add_paragraph()
+        dr = dp.add_run(self._date())
+        dr.font.size = Pt(10)
+        dp.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        doc.add_paragraph()
+        
+        for i, msg in enumerate(messages):
+            role = msg.get('role', 'user')
+            content = msg.get('content', '')
             
-            # Тест 2: text
-            omath2 = build_omath(r'V = \text{const}')
-            tests['text'] = f'OK ({len(list(omath2))} children)'
+            rp = doc.add_paragraph()
+            rr = rp.add_run('You' if role == 'user' else 'Gemini')
+            rr._r.style = USER_LABEL_STYLE if role == 'user' else MODEL_LABEL_STYLE
             
-            # Тест 3: греческие + Delta
-            omath3 = build_omath(r'A = P\Delta V')
-            tests['greek'] = f'OK ({len(list(omath3))} children)'
+            self._process(doc, content)
             
-            # Тест 4: ln
-            omath4 = build_omath(r'\nu RT \ln(V_2/V_1)')
-            tests['ln'] = f'OK ({len(list(omath4))} children)'
-            
-            test = 'ALL OK'
-        except Exception as e:
-            test = f'Error: {str(e)}'
-            traceback.print_exc()
+            if i < len(messages) - 1:
+                sp = doc.add_paragraph()
+                sr = sp.add_run('─' * 60)
+                sr._r.style = SEPARATOR_STYLE
         
-        r = json.dumps({
-            'status': 'OK',
-            'version': '5.0-full-parser',
-            'math_test': test,
-            'tests': tests
-        })
-        self.wfile.write(r.encode())
+        return doc
 
-    def do_POST(self):
-        try:
-            length = int(self.headers.get('Content-Length', 0))
-            data = json.loads(self.rfile.read(length).decode('utf-8'))
-            
-            messages = data.get('messages', [])
-            title = data.get('title', 'Gemini Chat')
-            
-            if not messages:
-                self.send_response(400)
-                self._cors()
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(b'{"error":"No messages"}')
-                return
-            
-            doc = Document()
-            
-            h = doc.add_heading(title, level=1)
-            h.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            dp = doc.add_paragraph()
-            dr = dp.add_run(self._date())
-            dr.font.size = Pt(10)
-            dp.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            doc.add_paragraph()
-            
-            for i, msg in enumerate(messages):
-                role = msg.get('role', 'user')
-                content = msg.get('content', '')
-                
-                rp = doc.add_paragraph()
-                rr = rp.add_run('You' if role == 'user' else 'Gemini')
-                rr.bold = True
-                rr.font.size = Pt(14)
-                rr.font.color.rgb = RGBColor(33, 150, 243) if role == 'user' else RGBColor(76, 175, 80)
-                
-                self._process(doc, content)
-                
-                if i < len(messages) - 1:
-                    sp = doc.add_paragraph()
-                    sr = sp.add_run('─' * 60)
-                    sr.font.color.rgb = RGBColor(200, 200, 200)
-            
-            buf = io.BytesIO()
-            doc.save(buf)
-            buf.seek(0)
-            
-            self.send_response(200)
-            self._cors()
-            self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-            self.send_header('Content-Disposition', 'attachment; filename="gemini-chat.docx"')
-            self.end_headers()
-            self.wfile.write(buf.getvalue())
-            
-        except Exception as e:
-            traceback.print_exc()
-            self.send_response(500)
-            self._cors()
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': str(e), 'trace': traceback.format_exc()}).encode())
+    def render_bytes(self, messages, title='Gemini Chat'):
+        buf = io.BytesIO()
+        self.render(messages, title).save(buf)
+        return buf.getvalue()
 
     def _process(self, doc, content):
         lines = content.split('\n')
@@ -640,12 +857,13 @@ class handler(BaseHTTPRequestHandler):
                 continue
             
             if line.strip().startswith('```'):
+                lang = line.strip()[3:].strip().lower()
                 code = []
                 i += 1
                 while i < len(lines) and not lines[i].strip().startswith('```'):
                     code.append(lines[i])
                     i += 1
-                self._code(doc, '\n'.join(code))
+                self._code(doc, '\n'.join(code), lang.split()[0] if lang else None)
                 i += 1
                 continue
             
@@ -708,14 +926,14 @@ class handler(BaseHTTPRequestHandler):
         if len(parts) <= 1:
             # Нет формул
             run = para.add_run(text)
-            run.font.size = Pt(11)
+            run._r.style = TABLE_CELL_STYLE
             return
         
         for idx, part in enumerate(parts):
             if idx % 2 == 0:
                 if part.strip():
                     run = para.add_run(part)
-                    run.font.size = Pt(11)
+                    run._r.style = TABLE_CELL_STYLE
             else:
                 insert_math(para, part.strip())
 
@@ -731,7 +949,7 @@ class handler(BaseHTTPRequestHandler):
             return
         mc = max(len(r) for r in rows)
         t = doc.add_table(rows=len(rows), cols=mc)
-        t.style = 'Table Grid'
+        t._tbl.tblStyle_val = 'TableGrid'  # без поиска стиля по имени
         for i, rd in enumerate(rows):
             for j, ct in enumerate(rd):
                 if j < mc:
@@ -740,34 +958,58 @@ class handler(BaseHTTPRequestHandler):
                         self._add_cell_content_with_math(cell, ct)
                     else:
                         run = cell.paragraphs[0].add_run(ct)
-                        run.font.size = Pt(11)
+                        run._r.style = TABLE_CELL_STYLE
                     if i == 0:
                         for run in cell.paragraphs[0].runs:
                             run.bold = True
 
     def _fmt(self, para, text):
+        # Собираем фрагменты (текст, bold, italic), соседние с одинаковым форматом сливаем
+        frags = []
         bparts = re.split(r'\*\*(.+?)\*\*', text)
         for i, bp in enumerate(bparts):
             if i % 2 == 0:
                 iparts = re.split(r'\*(.+?)\*', bp)
                 for j, ip in enumerate(iparts):
-                    if j % 2 == 0:
-                        if ip: para.add_run(ip)
-                    else:
-                        r = para.add_run(ip)
-                        r.italic = True
+                    if ip:
+                        frags.append([ip, False, j % 2 == 1])
+            elif bp:
+                frags.append([bp, True, False])
+        merged = []
+        for f in frags:
+            if merged and merged[-1][1:] == f[1:]:
+                merged[-1][0] += f[0]
             else:
-                r = para.add_run(bp)
+                merged.append(f)
+        for ftext, bold, italic in merged:
+            r = para.add_run(ftext)
+            if bold:
                 r.bold = True
+            if italic:
+                r.italic = True
 
-    def _code(self, doc, code):
+    def _code(self, doc, code, lang=None):
+        """Блок кода: строки через w:br, подсветка по языку из ```lang"""
         p = doc.add_paragraph()
-        r = p.add_run(code)
-        r.font.name = 'Courier New'
-        r.font.size = Pt(10)
-        s = OxmlElement('w:shd')
-        s.set(qn('w:fill'), 'F5F5F5')
-        p._element.get_or_add_pPr().append(s)
+        p._p.style = CODE_STYLE
+        lines = code.split('\n')
+        lang = _code_language(lang) if lang else None
+        if lang is None:
+            # Без подсветки — один run с w:br между строками
+            r = sub_el(p._p, W_NS, 'r')
+            for n, line in enumerate(lines):
+                if n:
+                    sub_el(r, W_NS, 'br')
+                line = line.rstrip('\r').expandtabs(4)
+                if line:
+                    t = sub_el(r, W_NS, 't')
+                    t.text = line
+                    if line != line.strip():
+                        t.set(XML_SPACE, 'preserve')
+            return
+        for n, line in enumerate(lines):
+            for r in _code_line_runs(lang, line.rstrip('\r'), n > 0):
+                p._p.append(copy.deepcopy(r))
 
     def _img(self, doc, src, alt=''):
         try:
@@ -790,3 +1032,389 @@ class handler(BaseHTTPRequestHandler):
     def _date(self):
         from datetime import datetime
         return datetime.now().strftime('%d.%m.%Y %H:%M')
+
+
+# =============================================
+# Admission control
+# =============================================
+
+# Веса оценки стоимости (условные единицы ~ CPU/память на рендеринг)
+COST_BASE = 5
+COST_PER_MESSAGE = 1
+COST_PER_KCHAR = 1
+COST_PER_FORMULA = 0.5
+COST_PER_TABLE_LINE = 1
+COST_PER_IMAGE = 40
+
+
+def estimate_cost(messages):
+    """Грубая оценка стоимости экспорта по разобранному payload (целое число)"""
+    cost = COST_BASE
+    for msg in messages:
+        content = msg.get('content', '') or ''
+        cost += COST_PER_MESSAGE
+        cost += len(content) / 1000 * COST_PER_KCHAR
+        cost += content.count('$') / 2 * COST_PER_FORMULA
+        cost += content.count('![') * COST_PER_IMAGE
+        if '|' in content:
+            cost += sum(1 for l in content.split('\n') if l.lstrip().startswith('|')) * COST_PER_TABLE_LINE
+    # Целые единицы: сумма в in_use не накапливает ошибку округления
+    return math.ceil(cost)
+
+
+class ExportScheduler:
+    """Пропускает экспорты в пределах бюджета; дешёвые запросы обслуживаются первыми.
+
+    Запрос, который не помещается в бюджет, ждёт в очереди не дольше max_wait
+    секунд, после чего отклоняется (429); при max_queue ожидающих новые запросы
+    отклоняются сразу. Запрос дороже всего бюджета выполняется один, когда
+    других нет. Чтобы поток дешёвых запросов не вытеснял дорогие навсегда,
+    запрос, прождавший половину max_wait, обслуживается вне очереди по цене.
+
+    Состояние живёт в одном процессе: на Vercel каждый инстанс функции
+    ограничивает только свои запросы, общего бюджета между инстансами нет.
+    """
+
+    def __init__(self, budget, max_wait, max_queue):
+        self.budget = budget
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.in_use = 0
+        self.active = 0  # число выполняющихся запросов
+        self.queued = 0
+        self.sec_per_cost = 0.001  # оценка времени рендеринга, уточняется в release
+        self._waiting = []  # [cost, seq, enqueued_at]
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, cost):
+        # Слишком дорогой запрос допускается, только когда воркер свободен
+        return self.in_use + cost <= self.budget or self.active == 0
+
+    def _next(self):
+        oldest = min(self._waiting, key=lambda e: e[1])
+        if time.monotonic() - oldest[2] >= self.max_wait / 2:
+            return oldest
+        return min(self._waiting)
+
+    def acquire(self, cost):
+        with self._cond:
+            if not self._waiting and self._fits(cost):
+                self.in_use += cost
+                self.active += 1
+                return True
+            if len(self._waiting) >= self.max_queue:
+                return False
+            self._seq += 1
+            now = time.monotonic()
+            entry = [cost, self._seq, now]
+            self._waiting.append(entry)
+            self.queued += cost
+            deadline = now + self.max_wait
+            try:
+                while not (self._next() is entry and self._fits(cost)):
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        return False
+                    # Просыпаемся и к моменту, когда старейший получит приоритет
+                    self._cond.wait(min(left, self.max_wait / 2))
+                self.in_use += cost
+                self.active += 1
+                return True
+            finally:
+                self._waiting.remove(entry)
+                self.queued = self.queued - cost if self._waiting else 0
+                self._cond.notify_all()
+
+    def release(self, cost, elapsed=None):
+        with self._cond:
+            self.in_use -= cost
+            self.active -= 1
+            if self.active == 0:
+                self.in_use = 0  # на случай дробных стоимостей от вызывающего кода
+            if elapsed is not None and cost > 0:
+                self.sec_per_cost += 0.2 * (elapsed / cost - self.sec_per_cost)
+            self._cond.notify_all()
+
+    def retry_after(self):
+        """Секунды до освобождения: оценка времени на текущую и ожидающую работу"""
+        with self._cond:
+            backlog = (self.in_use + self.queued) * self.sec_per_cost
+        return min(60, max(1, math.ceil(backlog)))
+
+
+SCHEDULER = ExportScheduler(
+    budget=float(os.environ.get('EXPORT_COST_BUDGET', 2000)),
+    max_wait=float(os.environ.get('EXPORT_MAX_WAIT', 5)),
+    max_queue=int(os.environ.get('EXPORT_MAX_QUEUE', 64)),
+)
+
+
+# =============================================
+# HTTP Handler
+# =============================================
+
+class handler(ChatRenderer, BaseHTTPRequestHandler):
+    
+    def _cors(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS, GET')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Expose-Headers', 'Retry-After')
+        self.send_header('Access-Control-Max-Age', '3600')
+    
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self._cors()
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(200)
+        self._cors()
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        
+        test = 'not tested'
+        tests = {}
+        try:
+            # Тест 1: простая дробь
+            omath = build_omath(r'\frac{a}{b}')
+            tests['frac'] = f'OK ({len(list(omath))} children)'
+            
+            # Тест 2: text
+            omath2 = build_omath(r'V = \text{const}')
+            tests['text'] = f'OK ({len(list(omath2))} children)'
+            
+            # Тест 3: греческие + Delta
+            omath3 = build_omath(r'A = P\Delta V')
+            tests['greek'] = f'OK ({len(list(omath3))} children)'
+            
+            # Тест 4: ln
+            omath4 = build_omath(r'\nu RT \ln(V_2/V_1)')
+            tests['ln'] = f'OK ({len(list(omath4))} children)'
+            
+            test = 'ALL OK'
+        except Exception as e:
+            test = f'Error: {str(e)}'
+            traceback.print_exc()
+        
+        r = json.dumps({
+            'status': 'OK',
+            'version': '5.0-full-parser',
+            'math_test': test,
+            'tests': tests
+        })
+        self.wfile.write(r.encode())
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            
+            messages = data.get('messages', [])
+            title = data.get('title', 'Gemini Chat')
+            
+            if not messages:
+                self.send_response(400)
+                self._cors()
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{"error":"No messages"}')
+                return
+            
+            cost = estimate_cost(messages)
+            if not SCHEDULER.acquire(cost):
+                self.send_response(429)
+                self._cors()
+                self.send_header('Retry-After', str(SCHEDULER.retry_after()))
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{"error":"Too many export requests, retry later"}')
+                return
+            started = time.monotonic()
+            try:
+                body = self.render_bytes(messages, title)
+            finally:
+                SCHEDULER.release(cost, time.monotonic() - started)
+            
+            self.send_response(200)
+            self._cors()
+            self.send_header('Content-Type', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+            self.send_header('Content-Disposition', 'attachment; filename="gemini-chat.docx"')
+            self.end_headers()
+            self.wfile.write(body)
+            
+        except Exception as e:
+            traceback.print_exc()
+            self.send_response(500)
+            self._cors()
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': str(e), 'trace': traceback.format_exc()}).encode())
+
+
+# =============================================
+# CLI: пакетная конвертация
+# =============================================
+
+PROGRESS_FILE = '.progress.jsonl'
+
+
+def _chat_entry(chat, fallback_id):
+    """Проверяет форму записи: (id, chat, None) или (id, None, ошибка)"""
+    if not isinstance(chat, dict):
+        return fallback_id, None, f'expected an object, got {type(chat).__name__}'
+    chat_id = str(chat.get('id', fallback_id))
+    messages = chat.get('messages')
+    if not isinstance(messages, list) or not all(isinstance(m, dict) for m in messages):
+        return chat_id, None, '"messages" must be a list of objects'
+    return chat_id, chat, None
+
+
+def _iter_chats(path):
+    """Читает чаты из .jsonl/.json файла или каталога: (id, chat, ошибка).
+
+    Битая запись не прерывает обход — для неё chat = None и описана ошибка.
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(('.jsonl', '.json')):
+                yield from _iter_chats(os.path.join(path, name))
+        return
+    # id по умолчанию включает абсолютный путь: одноимённые файлы из разных каталогов
+    # не совпадают, а resume работает независимо от того, как путь записан в аргументах
+    base = os.path.splitext(os.path.realpath(path))[0]
+    try:
+        with open(path, encoding='utf-8') as f:
+            if path.endswith('.json'):
+                try:
+                    data = json.load(f)
+                except ValueError as e:
+                    yield base, None, f'invalid JSON: {e}'
+                    return
+                if isinstance(data, list):
+                    for n, chat in enumerate(data, 1):
+                        yield _chat_entry(chat, f'{base}-{n}')
+                else:
+                    yield _chat_entry(data, base)
+                return
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    chat = json.loads(line)
+                except ValueError as e:
+                    yield f'{base}-{lineno}', None, f'invalid JSON: {e}'
+                    continue
+                yield _chat_entry(chat, f'{base}-{lineno}')
+    except (OSError, UnicodeDecodeError) as e:
+        yield base, None, str(e)
+
+
+def _safe_name(chat_id):
+    """Имя файла из id; короткий хэш исключает совпадения вроде c/1 и c_1"""
+    name = re.sub(r'[^\w.-]+', '_', chat_id).strip('._')[:80] or 'chat'
+    return f'{name}-{hashlib.sha1(chat_id.encode("utf-8")).hexdigest()[:8]}'
+
+
+def _convert_one(chat_id, chat, out_dir):
+    """Воркер: рендерит один чат и атомарно записывает .docx"""
+    import tempfile
+    messages = chat['messages']
+    body = ChatRenderer().render_bytes(messages, chat.get('title', 'Gemini Chat'))
+    target = os.path.join(out_dir, _safe_name(chat_id) + '.docx')
+    fd, tmp = tempfile.mkstemp(dir=out_dir, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return chat_id, len(messages), len(body)
+
+
+def _load_progress(out_dir):
+    done = set()
+    path = os.path.join(out_dir, PROGRESS_FILE)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['id'])
+                except (ValueError, KeyError):
+                    pass  # оборванная последняя строка после прерывания
+    return done
+
+
+def main(argv=None):
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+    ap = argparse.ArgumentParser(description='Bulk convert stored chats to .docx')
+    ap.add_argument('inputs', nargs='+', help='.jsonl/.json files or directories')
+    ap.add_argument('-o', '--out', required=True, help='output directory')
+    ap.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1)
+    ap.add_argument('--no-resume', action='store_true', help='ignore saved progress')
+    args = ap.parse_args(argv)
+
+    os.makedirs(args.out, exist_ok=True)
+    done = set() if args.no_resume else _load_progress(args.out)
+    progress = open(os.path.join(args.out, PROGRESS_FILE), 'a', encoding='utf-8')
+
+    chats = n_msgs = n_bytes = skipped = failed = 0
+    started = time.monotonic()
+    max_pending = args.workers * 4
+
+    def collect(finished):
+        nonlocal chats, n_msgs, n_bytes, failed
+        for fut in finished:
+            chat_id = pending.pop(fut)
+            try:
+                _, msgs, size = fut.result()
+            except Exception as e:
+                failed += 1
+                print(f'Failed "{chat_id}": {e}')
+                continue
+            progress.write(json.dumps({'id': chat_id, 'bytes': size}) + '\n')
+            progress.flush()
+            chats += 1
+            n_msgs += msgs
+            n_bytes += size
+
+    pending = {}
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            try:
+                for path in args.inputs:
+                    for chat_id, chat, error in _iter_chats(path):
+                        if error:
+                            failed += 1
+                            print(f'Failed "{chat_id}": {error}')
+                            continue
+                        # Уже сконвертированные и пустые чаты пропускаем
+                        if chat_id in done or not chat['messages']:
+                            skipped += 1
+                            continue
+                        done.add(chat_id)
+                        if len(pending) >= max_pending:
+                            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(finished)
+                        pending[pool.submit(_convert_one, chat_id, chat, args.out)] = chat_id
+            finally:
+                # Даже при прерывании записываем прогресс уже запущенных задач
+                while pending:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+    finally:
+        progress.close()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f'{chats} chats ({n_msgs} messages, {n_bytes / 1e6:.1f} MB) in {elapsed:.1f}s: '
+          f'{chats / elapsed:.1f} chats/s, {n_msgs / elapsed:.1f} msg/s, '
+          f'{n_bytes / 1e6 / elapsed:.2f} MB/s; {skipped} skipped, {failed} failed')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
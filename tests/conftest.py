@@ -0,0 +1,24 @@
+import importlib.util
+import pathlib
+import sys
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+def _load_export_chat():
+    # api/export-chat.py не импортируется обычным import из-за дефиса в имени
+    spec = importlib.util.spec_from_file_location('export_chat', ROOT / 'api' / 'export-chat.py')
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['export_chat'] = module  # воркерам ProcessPoolExecutor нужен модуль по имени
+    spec.loader.exec_module(module)
+    return module
+
+
+export_chat = _load_export_chat()
+
+
+@pytest.fixture(scope='session')
+def ec():
+    return export_chat
@@ -0,0 +1,90 @@
+import json
+import os
+
+
+def _chat(chat_id=None, n=1):
+    chat = {'title': 't', 'messages': [{'role': 'user', 'content': f'msg {k}'} for k in range(n)]}
+    if chat_id is not None:
+        chat['id'] = chat_id
+    return chat
+
+
+def _progress_ids(out):
+    with open(out / '.progress.jsonl', encoding='utf-8') as f:
+        return {json.loads(line)['id'] for line in f}
+
+
+def _docx(out):
+    return sorted(p for p in os.listdir(out) if p.endswith('.docx'))
+
+
+def test_bad_records_are_counted_and_do_not_abort(ec, tmp_path, capsys):
+    src = tmp_path / 'in'
+    src.mkdir()
+    (src / 'a.jsonl').write_text('\n'.join([
+        json.dumps(_chat('ok-1')),
+        '{not json',
+        json.dumps(['not', 'an', 'object']),
+        json.dumps({'id': 'bad-messages', 'messages': 'text'}),
+        json.dumps(_chat('empty', n=0)),
+        json.dumps(_chat('ok-2')),
+    ]), encoding='utf-8')
+    (src / 'b.json').write_text(json.dumps([_chat('list-1'), 5, _chat('list-2')]), encoding='utf-8')
+    out = tmp_path / 'out'
+
+    assert ec.main([str(src), '-o', str(out), '-j', '2']) == 1
+
+    summary = capsys.readouterr().out.strip().splitlines()[-1]
+    assert summary.startswith('4 chats')
+    assert '1 skipped, 4 failed' in summary
+    assert _progress_ids(out) == {'ok-1', 'ok-2', 'list-1', 'list-2'}
+    assert len(_docx(out)) == 4
+
+
+def test_resume_skips_finished_chats(ec, tmp_path, capsys):
+    src = tmp_path / 'chats.jsonl'
+    src.write_text('\n'.join(json.dumps(_chat()) for _ in range(5)), encoding='utf-8')
+    out = tmp_path / 'out'
+
+    assert ec.main([str(src), '-o', str(out), '-j', '2']) == 0
+    assert ec.main([str(src), '-o', str(out), '-j', '2']) == 0
+
+    summary = capsys.readouterr().out.strip().splitlines()[-1]
+    assert summary.startswith('0 chats') and '5 skipped' in summary
+    assert len(_docx(out)) == 5
+
+
+def test_similar_ids_do_not_overwrite_each_other(ec, tmp_path):
+    src = tmp_path / 'chats.jsonl'
+    src.write_text('\n'.join(json.dumps(_chat(i)) for i in ('c/1', 'c_1', 'c 1', 'c?1')), encoding='utf-8')
+    out = tmp_path / 'out'
+
+    assert ec.main([str(src), '-o', str(out), '-j', '1']) == 0
+    assert len(_docx(out)) == 4
+
+
+def test_same_file_name_in_different_directories(ec, tmp_path):
+    for d in ('x', 'y'):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / 'chats.jsonl').write_text(json.dumps(_chat()), encoding='utf-8')
+    out = tmp_path / 'out'
+
+    assert ec.main([str(tmp_path / 'x'), str(tmp_path / 'y'), '-o', str(out), '-j', '1']) == 0
+    assert len(_progress_ids(out)) == 2
+    assert len(_docx(out)) == 2
+
+
+def test_resume_with_relative_and_absolute_path(ec, tmp_path, monkeypatch, capsys):
+    src = tmp_path / 'chats.jsonl'
+    src.write_text('\n'.join(json.dumps(_chat()) for _ in range(2)), encoding='utf-8')
+    out = tmp_path / 'out'
+
+    monkeypatch.chdir(tmp_path)
+    assert ec.main(['chats.jsonl', '-o', str(out), '-j', '1']) == 0
+    monkeypatch.chdir(out)
+    assert ec.main([str(src), '-o', str(out), '-j', '1']) == 0
+    assert ec.main([os.path.join('..', 'chats.jsonl'), '-o', str(out), '-j', '1']) == 0
+
+    summary = capsys.readouterr().out.strip().splitlines()[-1]
+    assert summary.startswith('0 chats') and '2 skipped' in summary
+    assert len(_docx(out)) == 2
@@ -0,0 +1,89 @@
+import io
+import time
+import zipfile
+
+import pytest
+from docx import Document
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+
+SAMPLE = [
+    'def f(x):',
+    '    """Docstring"""',
+    '    if x > 10:  # comment',
+    "        return {'a': 1, \"b\": 2.5}",
+    '\treturn None',
+    '',
+]
+
+
+def _styles(ec, lang, line):
+    out = []
+    for r in ec._code_line_runs(lang, line, False):
+        rstyle = r.find(f'{{{W_NS}}}rPr/{{{W_NS}}}rStyle')
+        out.append((rstyle.get(f'{{{W_NS}}}val') if rstyle is not None else None, ''.join(r.itertext())))
+    return out
+
+
+def _code_paragraph(ec, code, lang):
+    doc = Document()
+    ec.add_chat_styles(doc)
+    ec.ChatRenderer()._code(doc, code, lang)
+    return doc.paragraphs[-1]
+
+
+@pytest.mark.parametrize('lang', [None, 'python', 'brainfuck'])
+def test_lines_are_separated_by_breaks(ec, lang):
+    p = _code_paragraph(ec, '\n'.join(SAMPLE), lang)
+    assert len(p._p.findall(f'.//{{{W_NS}}}br')) == len(SAMPLE) - 1
+    assert p.text == '\n'.join(line.expandtabs(4) for line in SAMPLE)
+
+
+def test_python_tokens_get_styles(ec):
+    assert _styles(ec, 'py', '    if x > 10:  # comment') == [
+        (None, '    '), (ec.CODE_KEYWORD_STYLE, 'if'), (None, ' x > '),
+        (ec.CODE_NUMBER_STYLE, '10'), (None, ':  '), (ec.CODE_COMMENT_STYLE, '# comment')]
+
+
+@pytest.mark.parametrize('lang, word', [('java', 'match'), ('go', 'match'), ('c', 'fn'), ('rust', 'chan')])
+def test_keywords_are_per_language(ec, lang, word):
+    assert _styles(ec, lang, f'{word} = 1;')[0] == (None, f'{word} = ')
+
+
+def test_go_and_rust_specifics(ec):
+    assert _styles(ec, 'go', 'defer f()')[0] == (ec.CODE_KEYWORD_STYLE, 'defer')
+    assert (ec.CODE_STRING_STYLE, '`raw`') in _styles(ec, 'go', 's := `raw`')
+    # Время жизни 'a не должно открывать строку
+    assert _styles(ec, 'rust', "fn f<'a>(x: &'a str)")[1] == (None, " f<'a>(x: &'a str)")
+
+
+def test_unknown_language_is_not_highlighted(ec):
+    assert _styles(ec, 'kotlin', 'fun main() = 1') == [(None, 'fun main() = 1')]
+
+
+@pytest.mark.parametrize('lang, ceiling', [(None, 0.5), ('python', 2.0)])
+def test_5000_line_dump_renders_in_bounded_time(ec, lang, ceiling):
+    code = '\n'.join(SAMPLE[k % 5] + f'  # {k}' * (k % 3 == 0) for k in range(5000))
+    content = f'```{lang or ""}\n{code}\n```'
+    started = time.monotonic()
+    body = ec.ChatRenderer().render_bytes([{'role': 'model', 'content': content}], 't')
+    elapsed = time.monotonic() - started
+    xml = zipfile.ZipFile(io.BytesIO(body)).read('word/document.xml')
+    assert xml.count(b'<w:br/>') == 4999
+    assert elapsed < ceiling, f'{elapsed:.2f}s'
+
+
+def test_lexer_cache_is_bounded_by_known_languages(ec):
+    doc = Document()
+    renderer = ec.ChatRenderer()
+    for lang in [f'lang{k}' for k in range(200)] + ['py', 'python', 'golang', 'go']:
+        renderer._code(doc, 'x = 1', lang)
+    assert ec._compile_lexer.cache_info().currsize <= len(ec.CODE_LANGUAGES)
+
+
+def test_aliases_share_line_cache(ec):
+    ec._code_line_runs.cache_clear()
+    _code_paragraph(ec, 'return 42', 'py')
+    _code_paragraph(ec, 'return 42', 'python')
+    info = ec._code_line_runs.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
@@ -0,0 +1,73 @@
+import random
+import time
+
+import pytest
+from docx import Document
+
+TOKENS = [
+    '{', '}', '\\left', '\\right', '\\left.', '\\right.', '(', ')', '[', ']',
+    '^', '_', '$', '\t', ' ', '\\', '\\frac', '\\sqrt', '\\sqrt[', '\\text',
+    '\\hat', '\\sum', '\\alpha', 'x', '1', '+', '=', ',',
+]
+MARGIN = 0.25
+
+
+def _check_bounded(ec, latex):
+    started = time.monotonic()
+    try:
+        ec.build_omath(latex)
+    except ec.FormulaTooComplex:
+        pass
+    assert time.monotonic() - started < ec.FORMULA_TIME_BUDGET + MARGIN, repr(latex[:80])
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_random_token_strings_parse_in_bounded_time(ec, seed):
+    rnd = random.Random(seed)
+    for _ in range(100):
+        latex = ''.join(rnd.choice(TOKENS) for _ in range(rnd.randint(1, 400)))
+        _check_bounded(ec, latex)
+
+
+@pytest.mark.parametrize('latex', [
+    '{' * 5000,
+    '{' * 1000,
+    'a_{' * 300,
+    'x^' * 300 + 'x',
+    'x_' * 300 + 'x',
+    '\\left' * 400,
+    '\\left(' * 300 + 'x',
+    '\\frac' * 300,
+    '\\sqrt[' * 300,
+    '\\left',
+    '}' * 1000,
+])
+def test_pathological_formulas(ec, latex):
+    _check_bounded(ec, latex)
+
+
+def test_nesting_limits(ec):
+    with pytest.raises(ec.FormulaTooComplex):
+        ec.build_omath('{' * 100 + 'x' + '}' * 100)
+    with pytest.raises(ec.FormulaTooComplex):
+        ec.build_omath('x^' * 300 + 'x')
+    with pytest.raises(ec.FormulaTooComplex):
+        ec.build_omath('x' * (ec.FORMULA_MAX_LENGTH + 1))
+    ec.build_omath('x^' * 10 + 'x')
+    ec.build_omath('{' * 10 + 'x' + '}' * 10)
+
+
+@pytest.mark.parametrize('latex', ['a}b', 'a$b', 'a\tb', '}ab', 'ab$'])
+def test_stray_characters_are_skipped(ec, latex):
+    # Раньше парсер зацикливался на }, $ и табуляции вне группы
+    started = time.monotonic()
+    omath = ec.build_omath(latex)
+    assert ''.join(omath.itertext()) == 'ab'
+    assert time.monotonic() - started < 0.05
+
+
+def test_insert_math_falls_back_to_text(ec):
+    p = Document().add_paragraph()
+    latex = 'x^' * 300 + 'x'
+    assert ec.insert_math(p, latex) is False
+    assert p.text == latex
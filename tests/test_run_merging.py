@@ -0,0 +1,60 @@
+from lxml import etree
+
+MATH_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/math'
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+TEXT_TAGS = (f'{{{MATH_NS}}}t', f'{{{W_NS}}}t')
+PROP_TAGS = (f'{{{MATH_NS}}}rPr', f'{{{W_NS}}}rPr')
+
+CONTENT = '\n'.join([
+    r'Energy $E = mc^2$ and $\frac{a+b}{c} = (x+y)^2 - [z]/2$, so $f(x), g(y) \to (a, b)$.',
+    r'$$\sum_{i=1}^{n} (a_i + b_i) \leq \sqrt{x^2+y^2}$$',
+    r'$$\left( \frac{1}{2} \right)^{n}, \text{const} = (a)_{k} + \infty, \nu RT \ln(V_2/V_1)$$',
+    r'**a****b** plain *x**y* and $p(x) := -(q)$',
+])
+
+
+def _chars(body):
+    """Каждый символ документа с путём предков и свойствами его run-а"""
+    out = []
+    for t in body.iter(*TEXT_TAGS):
+        run = t.getparent()
+        path = tuple(a.tag for a in run.iterancestors())
+        props = b''.join(etree.tostring(c) for c in run if c.tag in PROP_TAGS)
+        out.extend((ch, path, props) for ch in t.text or '')
+    return out
+
+
+def _runs(body):
+    return len(list(body.iter(f'{{{MATH_NS}}}r', f'{{{W_NS}}}r')))
+
+
+def _render(ec):
+    doc = ec.ChatRenderer().render([{'role': 'model', 'content': CONTENT}], 't')
+    return doc.element.body
+
+
+def test_merged_runs_keep_text_and_properties(ec, monkeypatch):
+    merged = _render(ec)
+
+    # Эталон без слияния: как раньше, отдельный m:r на каждый оператор
+    monkeypatch.setattr(ec, '_append_upright',
+                        lambda els, text: els.extend(ec.make_run(c, italic=False) for c in text))
+    reference = _render(ec)
+
+    assert _chars(merged) == _chars(reference)
+    assert _runs(merged) < _runs(reference)
+
+
+def test_script_base_is_not_merged(ec):
+    omath = ec.build_omath(r'a = (b)^2 + c_{1}')
+    ssup = omath.find(f'{{{MATH_NS}}}sSup')
+    base = ''.join(ssup.find(f'{{{MATH_NS}}}e').itertext())
+    assert base == ')'
+
+
+def test_fmt_merges_adjacent_fragments_with_same_format(ec):
+    from docx import Document
+    p = Document().add_paragraph()
+    ec.ChatRenderer()._fmt(p, '**a****b** plain *x**y*')
+    assert [(r.text, bool(r.bold), bool(r.italic)) for r in p.runs] == [
+        ('ab', True, False), (' plain ', False, False), ('xy', False, True)]
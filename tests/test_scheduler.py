@@ -0,0 +1,99 @@
+import threading
+import time
+
+
+def _hold(sched, cost, seconds, results=None):
+    ok = sched.acquire(cost)
+    if results is not None:
+        results.append((cost, ok))
+    if ok:
+        time.sleep(seconds)
+        sched.release(cost, seconds)
+    return ok
+
+
+def test_cheapest_waiting_request_runs_first(ec):
+    sched = ec.ExportScheduler(budget=100, max_wait=2, max_queue=8)
+    assert sched.acquire(90)
+    results = []
+    threads = [threading.Thread(target=_hold, args=(sched, c, 0.05, results)) for c in (50, 30, 5)]
+    for t in threads:
+        t.start()
+        time.sleep(0.02)
+    sched.release(90)
+    for t in threads:
+        t.join()
+    assert results == [(5, True), (30, True), (50, True)]
+    assert sched.in_use == 0 and sched.queued == 0
+
+
+def test_oversized_request_is_not_starved_by_small_traffic(ec):
+    sched = ec.ExportScheduler(budget=100, max_wait=1.0, max_queue=16)
+    stop = threading.Event()
+
+    def small_traffic():
+        while not stop.is_set():
+            _hold(sched, 10, 0.02)
+
+    workers = [threading.Thread(target=small_traffic) for _ in range(4)]
+    for w in workers:
+        w.start()
+    try:
+        time.sleep(0.1)
+        started = time.monotonic()
+        assert sched.acquire(5000)
+        assert time.monotonic() - started < 1.0
+        assert sched.in_use == 5000
+        sched.release(5000)
+    finally:
+        stop.set()
+        for w in workers:
+            w.join()
+
+
+def test_full_queue_rejects_immediately(ec):
+    sched = ec.ExportScheduler(budget=10, max_wait=5, max_queue=1)
+    assert sched.acquire(10)
+    waiter = threading.Thread(target=_hold, args=(sched, 10, 0))
+    waiter.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    assert not sched.acquire(1)
+    assert time.monotonic() - started < 0.5
+    sched.release(10)
+    waiter.join()
+
+
+def test_retry_after_follows_load(ec):
+    sched = ec.ExportScheduler(budget=10000, max_wait=5, max_queue=8)
+    assert sched.retry_after() == 1
+    sched.sec_per_cost = 0.01
+    assert sched.acquire(1000)
+    assert sched.retry_after() == 10
+    sched.release(1000)
+
+
+def test_float_costs_leave_no_residue(ec):
+    sched = ec.ExportScheduler(budget=100, max_wait=0.5, max_queue=8)
+    costs = [6.123, 11.07, 0.1, 7.3, 3.33]
+    for order in (costs, costs[::-1], costs[1::2] + costs[::2]):
+        for c in costs:
+            assert sched.acquire(c)
+        for c in order:
+            sched.release(c)
+        assert sched.in_use == 0 and sched.active == 0
+    started = time.monotonic()
+    assert sched.acquire(5000)
+    assert time.monotonic() - started < 0.1
+    sched.release(5000)
+
+
+def test_estimate_cost_is_integer(ec):
+    cost = ec.estimate_cost([{'role': 'user', 'content': 'x' * 1234 + ' $a$ | b |'}] * 3)
+    assert isinstance(cost, int)
+
+
+def test_estimate_cost_grows_with_payload(ec):
+    small = ec.estimate_cost([{'role': 'user', 'content': 'hi'}])
+    heavy = ec.estimate_cost([{'role': 'user', 'content': '| a |\n| b |\n$x$ ![i](x)'}] * 50)
+    assert small < heavy
@@ -0,0 +1,39 @@
+from lxml import etree
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+W_VAL = f'{{{W_NS}}}val'
+
+CONTENT = '\n'.join([
+    'Text with $x+1$ and a table:',
+    '| a | $b$ |',
+    '|---|---|',
+    '| 1 | 2 |',
+    '```python',
+    'def f(x):',
+    '    return "s" + 1  # c',
+    '```',
+])
+
+
+def test_all_chat_styles_are_defined_with_their_ids(ec):
+    doc = ec.ChatRenderer().render([{'role': 'user', 'content': 'hi'}], 't')
+    ids = {s.style_id: s.name for s in doc.styles}
+    for style_id, name in ec.STYLE_NAMES.items():
+        assert ids.get(style_id) == name
+
+
+def test_every_style_reference_resolves(ec):
+    messages = [{'role': 'user', 'content': CONTENT}, {'role': 'model', 'content': CONTENT}]
+    doc = ec.ChatRenderer().render(messages, 't')
+    defined = {s.style_id for s in doc.styles}
+    body = doc.element.body
+    refs = {el.get(W_VAL) for el in body.iter(f'{{{W_NS}}}rStyle', f'{{{W_NS}}}pStyle')}
+    assert ec.USER_LABEL_STYLE in refs and ec.CODE_STYLE in refs and ec.MATH_STYLE in refs
+    assert refs <= defined
+
+
+def test_runs_carry_no_direct_label_formatting(ec):
+    doc = ec.ChatRenderer().render([{'role': 'user', 'content': 'hi'}], 't')
+    label = [r for p in doc.paragraphs for r in p.runs if r.text == 'You'][0]
+    rpr = label._r.rPr
+    assert [etree.QName(c).localname for c in rpr] == ['rStyle']